@@ -2,16 +2,25 @@ import os
 from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
 
-from flask import Flask, request, url_for, render_template_string
+from flask import Flask, request, url_for
 from openpyxl import load_workbook
 
 import psycopg2
+import psycopg2.extras
+import psycopg2.pool
 import io
 import csv
-from flask import Response
+from contextlib import contextmanager
+import threading
+import atexit
+import hashlib
+import queue
+import weakref
+from time import monotonic, sleep
+from flask import Response, g, has_request_context
 
 from datetime import datetime, timedelta
-from datetime import time
+from datetime import date, time
 
 
 # =========================
@@ -20,9 +29,14 @@ from datetime import time
 JST = ZoneInfo("Asia/Tokyo")
 
 def jst_now():
+    # リクエスト中は before_request で取った時刻を使い回す（1リクエスト内で時刻がぶれない）
+    if has_request_context() and "jst_now" in g:
+        return g.jst_now
     return datetime.now(JST)
 
 def jst_today():
+    if has_request_context() and "jst_today" in g:
+        return g.jst_today
     return jst_now().date()
 
 
@@ -39,8 +53,16 @@ def load_quiz_bank_from_excel(path: str = QUIZ_XLSX_PATH, sheet_name: str = QUIZ
     任意列: category, explanation
     answer は 1〜4（人間に優しい）を想定し、内部では 0〜3 に変換する。
     """
-    wb = load_workbook(path, data_only=True)
+    # read_only: セルオブジェクトを全部メモリに組み立てず、行を順に読み出す
+    wb = load_workbook(path, data_only=True, read_only=True)
+    try:
+        return _parse_quiz_sheet(wb, path, sheet_name)
+    finally:
+        # read_only モードはファイルを開いたままにするので明示的に閉じる
+        wb.close()
 
+
+def _parse_quiz_sheet(wb, path: str, sheet_name: str):
     if sheet_name not in wb.sheetnames:
         raise ValueError(f"Sheet '{sheet_name}' not found in {path}. Found: {wb.sheetnames}")
 
@@ -56,21 +78,30 @@ def load_quiz_bank_from_excel(path: str = QUIZ_XLSX_PATH, sheet_name: str = QUIZ
     if missing:
         raise ValueError(f"Missing required columns in Excel header: {missing}. Header={headers}")
 
+    # 列位置は行ループの外で一度だけ引いておく
+    q_i = col["question"]
+    choice_is = [col["choice1"], col["choice2"], col["choice3"], col["choice4"]]
+    a_i = col["answer"]
+    cat_i = col.get("category")
+    exp_i = col.get("explanation")
+    width = len(headers)
+
     quiz_bank = []
     for row in ws.iter_rows(min_row=2, values_only=True):
         if not row:
             continue
 
-        q = row[col["question"]] if col["question"] < len(row) else None
+        # 末尾の空セルが省略された短い行は、ヘッダの列数まで None で埋めてから添字で読む
+        if len(row) < width:
+            row = row + (None,) * (width - len(row))
+
+        q = row[q_i]
         if q is None or str(q).strip() == "":
             continue
 
-        choices = []
-        for key in ["choice1", "choice2", "choice3", "choice4"]:
-            v = row[col[key]] if col[key] < len(row) else ""
-            choices.append("" if v is None else str(v))
+        choices = ["" if row[i] is None else str(row[i]) for i in choice_is]
 
-        ans_raw = row[col["answer"]] if col["answer"] < len(row) else None
+        ans_raw = row[a_i]
         try:
             ans = int(str(ans_raw).strip())
         except Exception:
@@ -80,12 +111,12 @@ def load_quiz_bank_from_excel(path: str = QUIZ_XLSX_PATH, sheet_name: str = QUIZ
             continue
 
         cat = ""
-        if "category" in col and col["category"] < len(row) and row[col["category"]] is not None:
-            cat = str(row[col["category"]]).strip()
+        if cat_i is not None and row[cat_i] is not None:
+            cat = str(row[cat_i]).strip()
 
         exp = ""
-        if "explanation" in col and col["explanation"] < len(row) and row[col["explanation"]] is not None:
-            exp = str(row[col["explanation"]]).strip()
+        if exp_i is not None and row[exp_i] is not None:
+            exp = str(row[exp_i]).strip()
 
         quiz_bank.append({
             "question": str(q).strip(),
@@ -101,17 +132,29 @@ def load_quiz_bank_from_excel(path: str = QUIZ_XLSX_PATH, sheet_name: str = QUIZ
     return quiz_bank
 
 
-def get_today_quiz(quiz_bank):
+# 今日のクイズは日付（JST）が変わるまで同じなので、日付をキーに1件だけ覚えておく
+# quiz: (日付, その日のクイズ)
+# index_page: (日付, 描画済みのログイン画面のバイト列)
+# どちらも (日付, 中身) を1つのタプルで入れ替えるので、日付が変わる瞬間でも別の日の組み合わせは読まれない
+_QUIZ_CACHE = {"quiz": None, "index_page": None}
+
+def get_today_quiz():
     today = jst_today()
-    key = today.year * 10000 + today.month * 100 + today.day
-    idx = key % len(quiz_bank)
-    return quiz_bank[idx]
+    cached = _QUIZ_CACHE["quiz"]
+    if cached is not None and cached[0] == today:
+        return cached[1]
+
+    # toordinal() は日付ごとに1ずつ増える整数なので、問題を順番に1問ずつ出題できる
+    quiz = QUIZ_BANK[today.toordinal() % QUIZ_COUNT]
+
+    _QUIZ_CACHE["quiz"] = (today, quiz)
+    return quiz
 
 
 # =========================
 # Database (PostgreSQL via Render)
 # =========================
-def get_db_conn():
+def get_db_url():
     url = os.environ.get("DATABASE_URL")
     if not url:
         raise RuntimeError("DATABASE_URL is not set (Render Environment Variables)")
@@ -121,403 +164,579 @@ def get_db_conn():
         joiner = "&" if "?" in url else "?"
         url = url + f"{joiner}sslmode=require"
 
-    return psycopg2.connect(url)
+    return url
+
+
+# リクエストを処理するスレッド数（gunicorn.conf.py と同じ GUNICORN_THREADS を見る）
+WEB_THREADS = int(os.environ.get("GUNICORN_THREADS", 8))
+
+DB_POOL_MINCONN = 1
+# ThreadedConnectionPool は空きが無いと待たずに PoolError になるので、
+# リクエストスレッドごとに1本 + 称号付与スレッド（title-grants）の1本を確保しておく。
+# プールはワーカー（プロセス）ごとなので、DB 全体では最大 workers × (GUNICORN_THREADS + 1) 本。
+# Postgres の max_connections（小さいプランでは 100 など）に収まるようにする
+DB_POOL_MAXCONN = WEB_THREADS + 1
+# 1文あたりの実行時間の上限（ミリ秒）。接続時に設定するので、リクエストごとの SET は不要
+DB_STATEMENT_TIMEOUT_MS = 10000
+
+_DB_POOL = None
+_DB_POOL_PID = None
+_DB_POOL_LOCK = threading.Lock()
+
+
+class KeepIdleConnectionPool(psycopg2.pool.ThreadedConnectionPool):
+    """
+    返された接続を maxconn 本まで閉じずに取っておくプール。
+    psycopg2 のプールは空き接続を minconn 本しか残さず、それ以上は返却時に close してしまう
+    （同時リクエストが重なるたびに接続・TLSハンドシェイクをやり直すことになる）。
+    最初に作るのは minconn 本だけで、残りは必要になったときに作る。
+    """
+
+    def __init__(self, minconn, maxconn, *args, **kwargs):
+        super().__init__(minconn, maxconn, *args, **kwargs)
+        # _putconn は「空き接続が minconn 本未満なら残す」判定なので、初回の接続後に maxconn に揃える
+        self.minconn = self.maxconn
+
+def get_db_pool():
+    """
+    接続プールを返す（プロセスごとに初回アクセス時に作成）。
+    gunicorn の fork 前に作った接続を子プロセスで共有しないよう、PIDが変わったら作り直す。
+    """
+    global _DB_POOL, _DB_POOL_PID
+    pid = os.getpid()
+    if _DB_POOL is None or _DB_POOL_PID != pid:
+        with _DB_POOL_LOCK:
+            if _DB_POOL is None or _DB_POOL_PID != pid:
+                _DB_POOL = KeepIdleConnectionPool(
+                    minconn=DB_POOL_MINCONN,
+                    maxconn=DB_POOL_MAXCONN,
+                    dsn=get_db_url(),
+                    options=f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}",
+                )
+                _DB_POOL_PID = pid
+    return _DB_POOL
+
+
+def close_db_pool():
+    """プールの接続をすべて閉じる（次に get_db_pool() したときに作り直される）"""
+    global _DB_POOL, _DB_POOL_PID
+    with _DB_POOL_LOCK:
+        if _DB_POOL is not None:
+            _DB_POOL.closeall()
+        _DB_POOL = None
+        _DB_POOL_PID = None
+
+
+# プロセス終了時にプールの接続を閉じる
+atexit.register(close_db_pool)
+
+
+@contextmanager
+def db_cursor(name=None):
+    """
+    プールから接続を借りてカーソルを返す。
+    ブロックを正常に抜けたらコミット、例外ならロールバックして、接続をプールに返す。
+    name を渡すとサーバーサイド（名前付き）カーソルになる。
+    """
+    db_pool = get_db_pool()
+    conn = db_pool.getconn()
+    try:
+        with conn:  # 正常終了で commit / 例外で rollback
+            with conn.cursor(name=name) as cur:
+                yield cur
+    finally:
+        db_pool.putconn(conn)
+
+
+# よく使うクエリは接続ごとに一度だけ PREPARE し、以降は EXECUTE で解析・プラン作成を省く
+# ページ分けする SELECT は ts が秒単位で重なるので、最後に id で並びを一意にする（ページ間の重複・抜けを防ぐ）
+PREPARED_STATEMENTS = {
+    "ins_wakeup": "INSERT INTO wakeups (name) VALUES ($1) RETURNING ts, day",
+    "sel_today": """
+        SELECT name, ts
+        FROM wakeups
+        WHERE day = $1
+        ORDER BY ts ASC, id ASC
+        LIMIT $2 OFFSET $3
+    """,
+    "stat_today": "SELECT MAX(id), COUNT(*) FROM wakeups WHERE day = $1",
+    "stat_history": "SELECT MAX(id), COUNT(*) FROM wakeups WHERE day BETWEEN $1 AND $2",
+    # 1ページ分の行を切り出してから、day ごとに [[name, ts], ...] へまとめる（1日1行で返ってくる）
+    "sel_history": """
+        SELECT day, json_agg(json_build_array(name, ts) ORDER BY ts ASC, id ASC) AS items
+        FROM (
+            SELECT id, day, name, ts
+            FROM wakeups
+            WHERE day BETWEEN $1 AND $2
+            ORDER BY day DESC, ts ASC, id ASC
+            LIMIT $3 OFFSET $4
+        ) page
+        GROUP BY day
+        ORDER BY day DESC
+    """,
+    # 同一日の中で最小tsを採用（＝一番早いログインをその日の起床とみなす）
+    # 連続日数は gaps-and-islands：降順の行番号を day に足すと、連続している日は同じ値(grp)になる。
+    # 先頭行（最新日）と同じ grp の行数がそのまま連続日数（直近 $2 日まで）
+    "sel_recent_wakeups": """
+        WITH days AS (
+            SELECT day, MIN(ts) AS ts
+            FROM wakeups
+            WHERE name = $1
+            GROUP BY day
+            ORDER BY day DESC
+            LIMIT $2
+        ), islands AS (
+            SELECT day, ts, day + (ROW_NUMBER() OVER (ORDER BY day DESC))::int AS grp
+            FROM days
+        )
+        SELECT day, ts, COUNT(*) OVER (PARTITION BY grp) AS run
+        FROM islands
+        ORDER BY day DESC
+        LIMIT $3
+    """,
+    # 各日の最速(tsが最小)の name（同点は名前順で1人）
+    "sel_earliest_by_day": """
+        SELECT DISTINCT ON (day) day, name
+        FROM wakeups
+        WHERE day = ANY($1)
+        ORDER BY day, ts ASC, name ASC
+    """,
+}
+
+# PREPARE 済みの接続（プールから外れて捨てられた接続は自動で消える）
+_PREPARED_CONNS = weakref.WeakSet()
+
+# すべての PREPARE を1回で送るための SQL（接続ごとの往復は1回で済む）
+_PREPARE_ALL_SQL = ";\n".join(
+    f"PREPARE {name} AS {sql}" for name, sql in PREPARED_STATEMENTS.items()
+)
+
+def execute_prepared(cur, name: str, params: tuple):
+    """
+    PREPARED_STATEMENTS[name] を実行する。その接続で初めてなら、先に全部の文をまとめて PREPARE する。
+    プール経由で接続が使い回されるので、PREPARE はリクエストをまたいで有効。
+    """
+    if cur.connection not in _PREPARED_CONNS:
+        cur.execute(_PREPARE_ALL_SQL)
+        _PREPARED_CONNS.add(cur.connection)
+
+    placeholders = ", ".join(["%s"] * len(params))
+    cur.execute(f"EXECUTE {name} ({placeholders})", params)
+
+
+# 起床時刻・日付の DEFAULT（JST の現在時刻。ts は秒で切り捨て）
+WAKEUP_TS_DEFAULT = "date_trunc('second', now() AT TIME ZONE 'Asia/Tokyo')::time"
+WAKEUP_DAY_DEFAULT = "(now() AT TIME ZONE 'Asia/Tokyo')::date"
+
+# init_db がテーブルのロックを待つ上限（ミリ秒）
+INIT_DB_LOCK_TIMEOUT_MS = 5000
 
 
 def init_db():
-    conn = get_db_conn()
-    cur = conn.cursor()
-
-    # 起床ログ（既存）
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS wakeups (
-            id SERIAL PRIMARY KEY,
-            name TEXT NOT NULL,
-            ts TEXT NOT NULL,
-            day TEXT NOT NULL
-        );
-    """)
-
-    # 称号マスタ
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS titles (
-            id SERIAL PRIMARY KEY,
-            code TEXT UNIQUE NOT NULL,
-            name TEXT NOT NULL,
-            description TEXT NOT NULL,
-            is_hidden BOOLEAN NOT NULL DEFAULT FALSE
-        );
-    """)
-
-    # ユーザー称号（獲得履歴）
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS user_titles (
-            id SERIAL PRIMARY KEY,
-            user_name TEXT NOT NULL,
-            title_code TEXT NOT NULL,
-            acquired_day TEXT NOT NULL,
-            UNIQUE(user_name, title_code)
-        );
-    """)
-
-    conn.commit()
-    cur.close()
-    conn.close()
+    with db_cursor() as cur:
+        # 既存データの型変換やインデックス作成は時間がかかることがあるので、起動時だけ実行時間の上限を外す。
+        # ただしロック待ちは短く切る（待っている間は他のリクエストも wakeups の前で詰まるため）。
+        # 取れなければ例外になり、起動時の except でログを出してそのまま起動する
+        cur.execute("SET LOCAL statement_timeout = 0")
+        cur.execute(f"SET LOCAL lock_timeout = {INIT_DB_LOCK_TIMEOUT_MS}")
+
+        # 起床ログ（既存）
+        # 起床時刻・日付は INSERT 時に DB 側（JST）で埋める
+        cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS wakeups (
+                id SERIAL PRIMARY KEY,
+                name TEXT NOT NULL,
+                ts TIME NOT NULL DEFAULT {WAKEUP_TS_DEFAULT},
+                day DATE NOT NULL DEFAULT {WAKEUP_DAY_DEFAULT}
+            );
+        """)
 
-def seed_titles():
-    titles = [
-        # 連続ログイン
-        ("streak_3", "3日坊主卒業", "3日連続でログインした", False),
-        ("streak_7", "習慣化マスター", "7日連続でログインした", False),
-        ("streak_14", "朝活職人", "14日連続でログインした", False),
-
-        # 規則正しい生活
-        ("regular_3", "規則正しい生活", "前日の起床時刻±30分以内を3日連続で達成した", False),
-
-        # 隠し称号（今は登録だけ。判定は後で）
-        ("noon_3", "昼夜逆転", "12:00以降の起床を3日以上達成した", True),
-        ("earlyking_3", "早起き王", "最速起床を3日連続で達成した", True),
-        ("no_sleep_3", "もしかして寝てない？", "04:00以前の起床を3日以上達成した", True),
+        # 既存テーブルは型と DEFAULT を確認して、必要なときだけ ALTER する。
+        # ALTER TABLE は wakeups に ACCESS EXCLUSIVE ロックを取るので、最新のスキーマなら起動時に一切ロックしない
+        cur.execute("""
+            SELECT column_name, data_type, column_default
+            FROM information_schema.columns
+            WHERE table_name = 'wakeups' AND column_name IN ('ts', 'day')
+        """)
+        columns = {name: (data_type, default) for name, data_type, default in cur.fetchall()}
+
+        # 型変換やインデックス作成をしたときだけ、最後に統計を取り直す
+        wakeups_changed = False
+
+        if columns["day"][0] == "text":
+            # 以前は ts / day を文字列（TEXT）で持っていたので、TIME / DATE に変換して DEFAULT を付け直す
+            cur.execute(f"""
+                ALTER TABLE wakeups
+                    ALTER COLUMN ts DROP DEFAULT,
+                    ALTER COLUMN day DROP DEFAULT,
+                    ALTER COLUMN ts TYPE TIME USING ts::time,
+                    ALTER COLUMN day TYPE DATE USING day::date,
+                    ALTER COLUMN ts SET DEFAULT {WAKEUP_TS_DEFAULT},
+                    ALTER COLUMN day SET DEFAULT {WAKEUP_DAY_DEFAULT};
+            """)
+            wakeups_changed = True
+        elif columns["ts"][1] is None or columns["day"][1] is None:
+            # DEFAULT が付いていない古いテーブルにだけ付与する
+            cur.execute(f"""
+                ALTER TABLE wakeups
+                    ALTER COLUMN ts SET DEFAULT {WAKEUP_TS_DEFAULT},
+                    ALTER COLUMN day SET DEFAULT {WAKEUP_DAY_DEFAULT};
+            """)
+
+        # CREATE INDEX は IF NOT EXISTS でも先に SHARE ロックを取り、書き込み中のトランザクションを待ってしまう。
+        # 無いインデックスだけ作る
+        cur.execute("SELECT indexname FROM pg_indexes WHERE tablename = 'wakeups'")
+        existing_indexes = {row[0] for row in cur.fetchall()}
+
+        # /today・/history・CSV は「day で絞って ts 順」なので (day, ts) の複合インデックスで並べ替えを省く
+        if "idx_wakeups_day_ts" not in existing_indexes:
+            cur.execute("""
+                CREATE INDEX IF NOT EXISTS idx_wakeups_day_ts ON wakeups (day, ts);
+            """)
+            wakeups_changed = True
+
+        # ログイン時の称号判定は「name で絞って day 降順・日ごとの最小 ts」なので ts まで含めて索引だけで済ませる
+        if "idx_wakeups_name_day" not in existing_indexes:
+            cur.execute("""
+                CREATE INDEX IF NOT EXISTS idx_wakeups_name_day ON wakeups (name, day DESC, ts);
+            """)
+            wakeups_changed = True
+
+        # 称号マスタ
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS titles (
+                id SERIAL PRIMARY KEY,
+                code TEXT UNIQUE NOT NULL,
+                name TEXT NOT NULL,
+                description TEXT NOT NULL,
+                is_hidden BOOLEAN NOT NULL DEFAULT FALSE
+            );
+        """)
+
+        # ユーザー称号（獲得履歴）
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS user_titles (
+                id SERIAL PRIMARY KEY,
+                user_name TEXT NOT NULL,
+                title_code TEXT NOT NULL,
+                acquired_day TEXT NOT NULL,
+                UNIQUE(user_name, title_code)
+            );
+        """)
+
+        # 新しく作ったインデックス・変換した列をプランナがすぐ使えるよう統計を更新しておく。
+        # スキーマが最新なら何もしない（ANALYZE もロックを取るので、毎回の起動では走らせない）
+        if wakeups_changed:
+            cur.execute("ANALYZE wakeups;")
+
+
+# 称号マスタ（起動時に titles テーブルへ反映する）
+TITLES = [
+    # 連続ログイン
+    ("streak_3", "3日坊主卒業", "3日連続でログインした", False),
+    ("streak_7", "習慣化マスター", "7日連続でログインした", False),
+    ("streak_14", "朝活職人", "14日連続でログインした", False),
+
+    # 規則正しい生活
+    ("regular_3", "規則正しい生活", "前日の起床時刻±30分以内を3日連続で達成した", False),
+
+    # 隠し称号（今は登録だけ。判定は後で）
+    ("noon_3", "昼夜逆転", "12:00以降の起床を3日以上達成した", True),
+    ("earlyking_3", "早起き王", "最速起床を3日連続で達成した", True),
+    ("no_sleep_3", "もしかして寝てない？", "04:00以前の起床を3日以上達成した", True),
+]
+
+
+# 連続ログイン称号：(必要な連続日数, 称号code)
+STREAK_TITLES = (
+    (3, "streak_3"),
+    (7, "streak_7"),
+    (14, "streak_14"),
+)
+
+
+def _titles_digest(titles) -> str:
+    # DB 側の md5(string_agg(...)) と同じ形に並べてハッシュする（code はASCIIなのでそのままの並びで "C" 照合順と一致）
+    lines = [
+        f"{code}|{name}|{desc}|{'true' if hidden else 'false'}"
+        for code, name, desc, hidden in sorted(titles)
     ]
+    return hashlib.md5("\n".join(lines).encode("utf-8")).hexdigest()
 
-    conn = get_db_conn()
-    cur = conn.cursor()
 
-    # 既に同じcodeがあれば何もしない（upsert）
-    for code, name, desc, hidden in titles:
+def seed_titles():
+    with db_cursor() as cur:
+        # 既に登録内容が TITLES と完全に同じなら何もしない（ワーカー起動のたびに書き込まない）
         cur.execute("""
+            SELECT md5(string_agg(
+                code || '|' || name || '|' || description || '|' || is_hidden::text,
+                E'\\n' ORDER BY code COLLATE "C"
+            ))
+            FROM titles
+        """)
+        if cur.fetchone()[0] == _titles_digest(TITLES):
+            return
+
+        # 同じcodeがあれば内容を更新（upsert）。全件を1回の INSERT で送る
+        psycopg2.extras.execute_values(cur, """
             INSERT INTO titles (code, name, description, is_hidden)
-            VALUES (%s, %s, %s, %s)
+            VALUES %s
             ON CONFLICT (code) DO UPDATE
             SET name = EXCLUDED.name,
                 description = EXCLUDED.description,
-                is_hidden = EXCLUDED.is_hidden;
-        """, (code, name, desc, hidden))
+                is_hidden = EXCLUDED.is_hidden
+        """, TITLES)
 
-    conn.commit()
-    cur.close()
-    conn.close()
 
-def get_user_login_days(user_name: str, limit: int = 60):
+def insert_wakeup(cur, name: str):
     """
-    指定ユーザーのログイン日（day）を新しい順で返す。
-    同一日の複数ログインは1日として扱う（DISTINCT）。
+    起床ログを1件記録し、記録された (ts, day) を返す。
+    ts / day は DB 側の DEFAULT で JST の現在時刻が入る。
     """
-    conn = get_db_conn()
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT DISTINCT day
-        FROM wakeups
-        WHERE name = %s
-        ORDER BY day DESC
-        LIMIT %s
-    """, (user_name, limit))
-    days = [r[0] for r in cur.fetchall()]
-    cur.close()
-    conn.close()
-    return days
+    execute_prepared(cur, "ins_wakeup", (name,))
+    return cur.fetchone()
 
 
-def calc_streak_days(days_desc: list[str]) -> int:
+def grant_titles_if_not_owned(cur, grants: list[tuple[str, str, str]]) -> int:
     """
-    days_desc: ["2026-01-15", "2026-01-14", ...] のような降順
-    連続日数を計算して返す（今日から途切れるまで）
+    grants: [(user_name, title_code, acquired_day), ...]
+    既に持っていたら何もしない。持っていなければ付与する。
+    1回の INSERT（複数行）にまとめて送る。
+    返り値: 新しく付与した件数
     """
-    if not days_desc:
+    if not grants:
         return 0
 
-    streak = 1
-    prev = datetime.strptime(days_desc[0], "%Y-%m-%d").date()
-    for d in days_desc[1:]:
-        cur = datetime.strptime(d, "%Y-%m-%d").date()
-        if prev - cur == timedelta(days=1):
-            streak += 1
-            prev = cur
-        else:
-            break
-    return streak
-
-
-def grant_title_if_not_owned(user_name: str, title_code: str, acquired_day: str):
-    """
-    既に持っていたら何もしない。持っていなければ付与する。
-    """
-    conn = get_db_conn()
-    cur = conn.cursor()
-    cur.execute("""
+    psycopg2.extras.execute_values(cur, """
         INSERT INTO user_titles (user_name, title_code, acquired_day)
-        VALUES (%s, %s, %s)
+        VALUES %s
         ON CONFLICT (user_name, title_code) DO NOTHING
-    """, (user_name, title_code, acquired_day))
-    conn.commit()
-    cur.close()
-    conn.close()
+    """, grants)
+    return cur.rowcount
 
 
-def evaluate_and_grant_streak_titles(user_name: str, today_str: str):
-    """
-    連続ログイン称号（3/7/14）を判定して付与する。
-    """
-    days_desc = get_user_login_days(user_name, limit=60)
-    streak = calc_streak_days(days_desc)
+# 称号一覧（/titles）のキャッシュ。保持者が変わるのは称号付与のときだけなので短時間使い回す
+TITLES_CACHE_TTL = 30  # 秒
+# entry: (期限, 一覧)。generation は捨てるたびに増やす（取得中に捨てられた古い一覧を保存しないため）
+_TITLES_CACHE = {"generation": 0, "entry": None}
+_TITLES_CACHE_LOCK = threading.Lock()
 
-    if streak >= 3:
-        grant_title_if_not_owned(user_name, "streak_3", today_str)
-    if streak >= 7:
-        grant_title_if_not_owned(user_name, "streak_7", today_str)
-    if streak >= 14:
-        grant_title_if_not_owned(user_name, "streak_14", today_str)
 
-    return streak
+def invalidate_titles_cache():
+    # 新しく称号を付与したら、次の /titles で取り直させる
+    with _TITLES_CACHE_LOCK:
+        _TITLES_CACHE["generation"] += 1
+        _TITLES_CACHE["entry"] = None
 
 
 def fetch_titles_with_holders():
     """
     称号一覧（titles）と保持者一覧（user_titles）を結合して返す。
     隠し称号は、保持者がいる場合のみ表示する。
+    TITLES_CACHE_TTL 秒の間は前回の結果を返す。
     """
-    conn = get_db_conn()
-    cur = conn.cursor()
-
-    # titles と user_titles を左結合して保持者をまとめる
-    cur.execute("""
-        SELECT
-            t.code, t.name, t.description, t.is_hidden,
-            ut.user_name
-        FROM titles t
-        LEFT JOIN user_titles ut
-          ON t.code = ut.title_code
-        ORDER BY t.id ASC, ut.user_name ASC
-    """)
-    rows = cur.fetchall()
-    cur.close()
-    conn.close()
-
-    # 整形
-    titles = {}
-    for code, name, desc, is_hidden, user_name in rows:
-        if code not in titles:
-            titles[code] = {
+    now = monotonic()
+    entry = _TITLES_CACHE["entry"]
+    if entry is not None and now < entry[0]:
+        return entry[1]
+
+    # クエリより前に読んでおく。取得中に付与がコミットされて捨てられたら、この結果は古いかもしれない
+    generation = _TITLES_CACHE["generation"]
+
+    with db_cursor() as cur:
+        # 保持者は DB 側で称号ごとの配列にまとめる（1称号1行で返ってくる）
+        # 保持者のいない隠し称号も DB 側で落とす
+        cur.execute("""
+            SELECT
+                t.code, t.name, t.description, t.is_hidden,
+                COALESCE(
+                    array_agg(ut.user_name ORDER BY ut.user_name)
+                        FILTER (WHERE ut.user_name IS NOT NULL),
+                    '{}'
+                ) AS holders
+            FROM titles t
+            LEFT JOIN user_titles ut
+              ON t.code = ut.title_code
+            GROUP BY t.id
+            HAVING NOT t.is_hidden OR COUNT(ut.user_name) > 0
+            ORDER BY t.id ASC
+        """)
+        # 整形（fetchall でいったんリストにせず、カーソルから直接組み立てる）
+        titles = [
+            {
                 "code": code,
                 "name": name,
                 "description": desc,
                 "is_hidden": bool(is_hidden),
-                "holders": []
+                "holders": holders,
             }
-        if user_name:
-            titles[code]["holders"].append(user_name)
-
-    # 隠し称号は保持者がいないなら表示しない
-    result = []
-    for t in titles.values():
-        if t["is_hidden"] and len(t["holders"]) == 0:
-            continue
-        result.append(t)
+            for code, name, desc, is_hidden, holders in cur
+        ]
 
-    return result
+    # 取得中に捨てられていなければ保存する（捨てられていたら今回は返すだけ）
+    with _TITLES_CACHE_LOCK:
+        if _TITLES_CACHE["generation"] == generation:
+            _TITLES_CACHE["entry"] = (now + TITLES_CACHE_TTL, titles)
+    return titles
 
 
 def fetch_user_titles(user_name: str):
     """
     特定ユーザーが持っている称号を返す（称号マスタ付き）
     """
-    conn = get_db_conn()
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT t.code, t.name, t.description, t.is_hidden, ut.acquired_day
-        FROM user_titles ut
-        JOIN titles t
-          ON ut.title_code = t.code
-        WHERE ut.user_name = %s
-        ORDER BY ut.acquired_day DESC, t.id ASC
-    """, (user_name,))
-    rows = cur.fetchall()
-    cur.close()
-    conn.close()
-
-    return [
-        {
-            "code": r[0],
-            "name": r[1],
-            "description": r[2],
-            "is_hidden": bool(r[3]),
-            "acquired_day": r[4],
-        }
-        for r in rows
-    ]
-
-def _parse_time(ts_str: str):
-    # "HH:MM:SS" 想定。 "HH:MM" しか無い場合も救う
-    parts = ts_str.split(":")
-    if len(parts) == 2:
-        h, m = int(parts[0]), int(parts[1])
-        s = 0
-    else:
-        h, m, s = int(parts[0]), int(parts[1]), int(parts[2])
-    return time(h, m, s)
-
+    with db_cursor() as cur:
+        cur.execute("""
+            SELECT t.code, t.name, t.description, t.is_hidden, ut.acquired_day
+            FROM user_titles ut
+            JOIN titles t
+              ON ut.title_code = t.code
+            WHERE ut.user_name = %s
+            ORDER BY ut.acquired_day DESC, t.id ASC
+        """, (user_name,))
+        # fetchall でいったんリストにせず、カーソルから直接組み立てる
+        return [
+            {
+                "code": r[0],
+                "name": r[1],
+                "description": r[2],
+                "is_hidden": bool(r[3]),
+                "acquired_day": r[4],
+            }
+            for r in cur
+        ]
 
-def get_user_wakeups(user_name: str, limit: int = 60):
+def fetch_recent_wakeups(cur, user_name: str, limit: int = 3, streak_window: int = 60):
     """
-    ユーザーの起床ログを新しい順で返す（同一日複数回は最初の1件だけにする）
-    返り値: [{"day": "...", "ts": "..."} ...] (降順)
+    ユーザーの直近 limit 日分の起床ログと、連続ログイン日数を返す（同一日複数回は最初の1件だけにする）
+    返り値: ([(day, ts), ...] (降順), streak)
+    ログイン時の称号判定は、この1回の取得結果をすべての判定で使い回す。
     """
-    conn = get_db_conn()
-    cur = conn.cursor()
-    # 同一日の中で最小tsを採用（＝一番早いログインをその日の起床とみなす）
-    cur.execute("""
-        SELECT day, MIN(ts) as ts
-        FROM wakeups
-        WHERE name = %s
-        GROUP BY day
-        ORDER BY day DESC
-        LIMIT %s
-    """, (user_name, limit))
+    # 連続日数は SQL 側で計算する（直近 streak_window 日まで）
+    execute_prepared(cur, "sel_recent_wakeups", (user_name, streak_window, limit))
     rows = cur.fetchall()
-    cur.close()
-    conn.close()
-    return [{"day": r[0], "ts": r[1]} for r in rows]
 
+    streak = rows[0][2] if rows else 0
+    return [(day, ts) for day, ts, _ in rows], streak
 
-def is_consecutive_days(days_desc: list[str], need: int) -> bool:
+
+def is_consecutive_days(days_desc: list[date], need: int) -> bool:
     """
     days_desc は降順。先頭から need 日が連続しているか。
     """
     if len(days_desc) < need:
         return False
-    prev = datetime.strptime(days_desc[0], "%Y-%m-%d").date()
+    prev = days_desc[0]
     for i in range(1, need):
-        cur = datetime.strptime(days_desc[i], "%Y-%m-%d").date()
+        cur = days_desc[i]
         if prev - cur != timedelta(days=1):
             return False
         prev = cur
     return True
 
 
-def evaluate_and_grant_regular_3(user_name: str, today_str: str):
+def _is_last_3_days_consecutive(logs) -> bool:
+    return len(logs) >= 3 and is_consecutive_days([day for day, _ in logs], 3)
+
+
+def _check_regular_3(logs) -> bool:
     """
     規則正しい生活：前日±30分以内の起床が3日連続
-    条件を判定し、満たせば regular_3 を付与
     """
-    logs = get_user_wakeups(user_name, limit=10)
-    if len(logs) < 3:
-        return False
-
     # 連続3日でなければ不成立
-    days_desc = [x["day"] for x in logs]
-    if not is_consecutive_days(days_desc, 3):
+    if not _is_last_3_days_consecutive(logs):
         return False
 
     # 時刻差を分で評価（前日との差が±30分以内が2回続けばOK）
     def minutes(t: time) -> int:
         return t.hour * 60 + t.minute  # 秒は丸め
 
-    t0 = minutes(_parse_time(logs[0]["ts"]))  # 今日
-    t1 = minutes(_parse_time(logs[1]["ts"]))  # 昨日
-    t2 = minutes(_parse_time(logs[2]["ts"]))  # 一昨日
+    t0 = minutes(logs[0][1])  # 今日
+    t1 = minutes(logs[1][1])  # 昨日
+    t2 = minutes(logs[2][1])  # 一昨日
 
     ok01 = abs(t0 - t1) <= 30
     ok12 = abs(t1 - t2) <= 30
+    return ok01 and ok12
 
-    if ok01 and ok12:
-        grant_title_if_not_owned(user_name, "regular_3", today_str)
-        return True
-    return False
 
-
-def evaluate_and_grant_noon_3(user_name: str, today_str: str):
+def _check_noon_3(logs) -> bool:
     """
     昼夜逆転：12:00以降の起床が3日連続
     """
-    logs = get_user_wakeups(user_name, limit=10)
-    if len(logs) < 3:
-        return False
-    days_desc = [x["day"] for x in logs]
-    if not is_consecutive_days(days_desc, 3):
+    if not _is_last_3_days_consecutive(logs):
         return False
 
-    def is_noon(ts: str) -> bool:
-        t = _parse_time(ts)
+    def is_noon(t: time) -> bool:
         return (t.hour >= 12)
 
-    if all(is_noon(x["ts"]) for x in logs[:3]):
-        grant_title_if_not_owned(user_name, "noon_3", today_str)
-        return True
-    return False
+    return all(is_noon(ts) for _, ts in logs[:3])
 
 
-def evaluate_and_grant_no_sleep_3(user_name: str, today_str: str):
+def _check_no_sleep_3(logs) -> bool:
     """
     もしかして寝てない？：04:00以前の起床が3日連続
     """
-    logs = get_user_wakeups(user_name, limit=10)
-    if len(logs) < 3:
-        return False
-    days_desc = [x["day"] for x in logs]
-    if not is_consecutive_days(days_desc, 3):
+    if not _is_last_3_days_consecutive(logs):
         return False
 
-    def is_too_early(ts: str) -> bool:
-        t = _parse_time(ts)
+    def is_too_early(t: time) -> bool:
         # 04:00:00 以前
         return (t.hour < 4) or (t.hour == 4 and t.minute == 0 and t.second == 0)
 
-    if all(is_too_early(x["ts"]) for x in logs[:3]):
-        grant_title_if_not_owned(user_name, "no_sleep_3", today_str)
-        return True
-    return False
+    return all(is_too_early(ts) for _, ts in logs[:3])
 
 
-def evaluate_and_grant_earlyking_3(today_str: str):
+def find_earlyking_3(cur, today: date):
     """
-    早起き王：その日の最速起床者を3日連続で取った人に付与
-    今日ログインした人だけで判定し、必要なら付与する。
+    早起き王：その日の最速起床者を3日連続で取った人を返す（いなければ None）
     """
     # 直近3日分（today, yesterday, day-2）の最速者を取る
-    today = datetime.strptime(today_str, "%Y-%m-%d").date()
-    days = [(today - timedelta(days=i)).strftime("%Y-%m-%d") for i in range(3)]
-
-    conn = get_db_conn()
-    cur = conn.cursor()
-
-    winners = []
-    for d in days:
-        # その日の最速(tsが最小)の name を取る（同点は名前順で1人）
-        cur.execute("""
-            SELECT name, MIN(ts) as ts
-            FROM wakeups
-            WHERE day = %s
-            GROUP BY name
-            ORDER BY ts ASC, name ASC
-            LIMIT 1
-        """, (d,))
-        row = cur.fetchone()
-        if not row:
-            winners.append(None)
-        else:
-            winners.append(row[0])
+    days = [today - timedelta(days=i) for i in range(3)]
 
-    cur.close()
-    conn.close()
+    # 各日の最速(tsが最小)の name を1回のクエリでまとめて取る（同点は名前順で1人）
+    execute_prepared(cur, "sel_earliest_by_day", (days,))
+    winner_by_day = dict(cur.fetchall())
+    winners = [winner_by_day.get(d) for d in days]
 
-    # 3日全部データが揃っていて、同じ人なら付与
+    # 3日全部データが揃っていて、同じ人なら早起き王
     if all(winners) and winners[0] == winners[1] == winners[2]:
-        grant_title_if_not_owned(winners[0], "earlyking_3", today_str)
         return winners[0]
     return None
 
 
-def evaluate_and_grant_all_titles(user_name: str, today_str: str):
+def evaluate_all_titles(cur, user_name: str, today: date):
     """
-    ログイン時に呼ぶ統合関数
+    ログイン時に呼ぶ統合関数（起床ログの INSERT と同じトランザクションの cur を受け取る）
+    起床ログは1回だけ取得し、各称号の判定はその結果に対して行う。
+    付与はしない。付与すべき称号を "grants" に入れて返すので、コミット後に enqueue_grants() に渡す。
     """
-    streak = evaluate_and_grant_streak_titles(user_name, today_str)
-    regular_ok = evaluate_and_grant_regular_3(user_name, today_str)
-    noon_ok = evaluate_and_grant_noon_3(user_name, today_str)
-    nosleep_ok = evaluate_and_grant_no_sleep_3(user_name, today_str)
-    earlyking_user = evaluate_and_grant_earlyking_3(today_str)
+    logs, streak = fetch_recent_wakeups(cur, user_name)
+
+    regular_ok = _check_regular_3(logs)
+    noon_ok = _check_noon_3(logs)
+    nosleep_ok = _check_no_sleep_3(logs)
+
+    earlyking_user = find_earlyking_3(cur, today)
+
+    # 付与する称号を集める（acquired_day は文字列で持つ）
+    today_str = today.isoformat()
+    to_grant = []
+    to_grant.extend(
+        (user_name, code, today_str)
+        for need, code in STREAK_TITLES
+        if streak >= need
+    )
+    if regular_ok:
+        to_grant.append((user_name, "regular_3", today_str))
+    if noon_ok:
+        to_grant.append((user_name, "noon_3", today_str))
+    if nosleep_ok:
+        to_grant.append((user_name, "no_sleep_3", today_str))
+    if earlyking_user:
+        to_grant.append((earlyking_user, "earlyking_3", today_str))
 
     return {
+        "grants": to_grant,
         "streak": streak,
         "regular_ok": regular_ok,
         "noon_ok": noon_ok,
@@ -526,13 +745,118 @@ def evaluate_and_grant_all_titles(user_name: str, today_str: str):
     }
 
 
+# 称号の付与（user_titles への書き込み）はレスポンスを待たせないよう、バックグラウンドのスレッドで行う。
+# 画面に出すメッセージは判定結果だけで決まるので、付与の完了を待つ必要はない。
+# ただし「獲得！」はもう表示済みで、3日窓の称号（規則正しい生活・早起き王など）は次のログインで
+# 条件を満たさなくなることもあるので、DB エラーで失敗した分は間隔を空けて何度かやり直す。
+GRANT_RETRY_ATTEMPTS = 5
+GRANT_RETRY_BACKOFF = 0.5  # 秒。失敗のたびに倍にする（0.5, 1, 2, 4 秒）
+
+_GRANT_QUEUE = None
+_GRANT_THREAD = None
+_GRANT_PID = None
+_GRANT_LOCK = threading.Lock()
+
+
+def _grant_worker(q):
+    while True:
+        grants = q.get()
+        try:
+            if grants is None:
+                return
+            _grant_with_retry(grants)
+        finally:
+            q.task_done()
+
+
+def _grant_with_retry(grants):
+    # ON CONFLICT DO NOTHING なので、途中まで書けていても同じバッチをそのままやり直してよい
+    for attempt in range(GRANT_RETRY_ATTEMPTS):
+        try:
+            with db_cursor() as cur:
+                granted = grant_titles_if_not_owned(cur, grants)
+        except Exception as e:
+            if attempt + 1 == GRANT_RETRY_ATTEMPTS:
+                print("title grant failed, giving up:", repr(e), grants)
+                return
+            print("title grant failed, retrying:", repr(e))
+            sleep(GRANT_RETRY_BACKOFF * (2 ** attempt))
+            continue
+
+        # コミット後に捨てる（コミット前に捨てると、別リクエストが古い一覧を取り直してしまう）
+        if granted:
+            invalidate_titles_cache()
+        return
+
+
+def enqueue_grants(grants: list[tuple[str, str, str]]):
+    """
+    称号付与をバックグラウンドのスレッドに頼む（プロセスごとに初回に起動）。
+    gunicorn の fork 前に作ったスレッドは子プロセスに引き継がれないので、PIDが変わったら作り直す。
+    付与はベストエフォート：DB エラーはやり直すが、書き込む前にプロセスが落ちた（タイムアウトで kill・OOM など）
+    場合や、やり直しても失敗し続けた場合はそのバッチは失われる（ログには残る）。
+    """
+    global _GRANT_QUEUE, _GRANT_THREAD, _GRANT_PID
+    if not grants:
+        return
+
+    pid = os.getpid()
+    # stop_grant_worker() と同時に呼ばれても壊れないよう、確認から put までロックの中で行う
+    with _GRANT_LOCK:
+        if _GRANT_THREAD is None or _GRANT_PID != pid or not _GRANT_THREAD.is_alive():
+            if _GRANT_PID == pid and _GRANT_QUEUE is not None:
+                # スレッドが落ちていたら作り直す。キューに残っている分はそのまま引き継ぐ
+                print("title grant worker is not running, restarting")
+                q = _GRANT_QUEUE
+            else:
+                q = queue.Queue()
+            thread = threading.Thread(
+                target=_grant_worker, args=(q,), name="title-grants", daemon=True
+            )
+            try:
+                thread.start()
+            except RuntimeError as e:
+                # インタープリタの終了処理中などでスレッドを作れないときは、このバッチは諦める
+                print("title grant worker could not start:", repr(e), grants)
+                return
+            _GRANT_QUEUE = q
+            _GRANT_THREAD = thread
+            _GRANT_PID = pid
+        _GRANT_QUEUE.put(grants)
+
+
+def stop_grant_worker(timeout: float = 10.0):
+    """残っている付与を書き終えてからスレッドを止める（やり直しの待ち時間が収まるよう timeout は長めに取る）"""
+    global _GRANT_QUEUE, _GRANT_THREAD, _GRANT_PID
+    with _GRANT_LOCK:
+        if _GRANT_THREAD is not None and _GRANT_PID == os.getpid():
+            _GRANT_QUEUE.put(None)
+            _GRANT_THREAD.join(timeout)
+        _GRANT_QUEUE = None
+        _GRANT_THREAD = None
+        _GRANT_PID = None
+
+
+# プロセス終了時に残りの付与を書き切る（atexit は後に登録したものから動くので、プールを閉じる前に走る）
+atexit.register(stop_grant_worker)
+
+
 # =========================
 # Flask app
 # =========================
 app = Flask(__name__)
 
+
+@app.before_request
+def set_request_clock():
+    # このリクエストの「今」（JST）を一度だけ取得する
+    g.jst_now = datetime.now(JST)
+    g.jst_today = g.jst_now.date()
+
+
 # 起動時に一度だけ準備
 QUIZ_BANK = load_quiz_bank_from_excel()
+QUIZ_COUNT = len(QUIZ_BANK)
 try:
     init_db()
     seed_titles()
@@ -628,6 +952,10 @@ TODAY_HTML = """
       <p>まだ誰も起きていません…？</p>
     {% endif %}
 
+    {% if next_offset is not none %}
+      <p><a href="{{ url_for('today', offset=next_offset) }}">続きを見る</a></p>
+    {% endif %}
+
     <p><a href="{{ url_for('index') }}">ログインページに戻る</a></p>
     <p><a href="{{ url_for('history') }}">起床履歴を見る</a></p>
   </body>
@@ -655,6 +983,10 @@ HISTORY_HTML = """
       <p>まだ履歴がありません。</p>
     {% endif %}
 
+    {% if next_offset is not none %}
+      <p><a href="{{ url_for('history', offset=next_offset) }}">続きを見る</a></p>
+    {% endif %}
+
     <hr>
     <p><a href="{{ url_for('index') }}">ログインページに戻る</a></p>
     <p><a href="{{ url_for('today') }}">今日の起床時間を見る</a></p>
@@ -727,75 +1059,101 @@ TITLES_HTML = """
 </html>
 """
 
+# テンプレートは起動時に一度だけコンパイルして使い回す
+# （app.jinja_env を共有するので url_for などはそのまま使える）
+_INDEX_TPL = app.jinja_env.from_string(INDEX_HTML)
+_RESULT_TPL = app.jinja_env.from_string(RESULT_HTML)
+_TODAY_TPL = app.jinja_env.from_string(TODAY_HTML)
+_HISTORY_TPL = app.jinja_env.from_string(HISTORY_HTML)
+_TITLES_TPL = app.jinja_env.from_string(TITLES_HTML)
+
 
 # =========================
 # Routes
 # =========================
+def _render_index(error=None):
+    """今日のクイズでログイン画面を描画する"""
+    quiz = get_today_quiz()
+    return _INDEX_TPL.render(
+        error=error,
+        quiz_question=quiz["question"],
+        quiz_choices=quiz["choices"],
+        quiz_category=quiz.get("category", ""),
+        quiz_count=QUIZ_COUNT,
+    )
+
+
+def get_today_index_page():
+    """
+    今日のログイン画面（エラー表示なし）を描画済みのバイト列で返す。
+    中身は日付（JST）が変わるまで同じなので、その日最初のアクセスで一度だけ描画する。
+    """
+    today = jst_today()
+    cached = _QUIZ_CACHE["index_page"]
+    if cached is not None and cached[0] == today:
+        return cached[1]
+
+    page = _render_index().encode("utf-8")
+    _QUIZ_CACHE["index_page"] = (today, page)
+    return page
+
+
+# /today・/history は ETag で再検証させる。
+# max-age で鮮度を持たせると、ログイン直後に /today へ戻ったとき自分の記録が出ないことがあるので
+# 毎回再検証（no-cache）にして、変化がなければ 304 で本文の取得・描画を省く。
+PAGE_CACHE_CONTROL = "no-cache"
+
+def not_modified_response(etag: str):
+    resp = Response(status=304)
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = PAGE_CACHE_CONTROL
+    return resp
+
+
+def cacheable_response(body: str, etag: str):
+    resp = Response(body, mimetype="text/html")
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = PAGE_CACHE_CONTROL
+    return resp
+
+
 @app.route("/", methods=["GET", "POST"])
 def index():
-    quiz = get_today_quiz(QUIZ_BANK)
+    quiz = get_today_quiz()
 
     if request.method == "POST":
         name = request.form.get("name", "").strip()
         choice_idx_str = request.form.get("choice")
 
         if not name:
-            return render_template_string(
-                INDEX_HTML,
-                error="名前を入力してください。",
-                quiz_question=quiz["question"],
-                quiz_choices=quiz["choices"],
-                quiz_category=quiz.get("category", ""),
-                quiz_count=len(QUIZ_BANK),
-            )
+            return _render_index("名前を入力してください。")
 
         if choice_idx_str is None:
-            return render_template_string(
-                INDEX_HTML,
-                error="クイズの選択肢を選んでください。",
-                quiz_question=quiz["question"],
-                quiz_choices=quiz["choices"],
-                quiz_category=quiz.get("category", ""),
-                quiz_count=len(QUIZ_BANK),
-            )
+            return _render_index("クイズの選択肢を選んでください。")
 
         try:
             choice_idx = int(choice_idx_str)
         except ValueError:
-            return render_template_string(
-                INDEX_HTML,
-                error="選択肢が不正です。",
-                quiz_question=quiz["question"],
-                quiz_choices=quiz["choices"],
-                quiz_category=quiz.get("category", ""),
-                quiz_count=len(QUIZ_BANK),
-            )
+            return _render_index("選択肢が不正です。")
 
         if choice_idx != quiz["answer_index"]:
-            return render_template_string(
-                RESULT_HTML,
+            return _RESULT_TPL.render(
                 ok=False,
                 title="❌ 不正解！",
                 message="もう一度考えてみよう！",
                 explanation=None,
             )
 
-        # 正解 → 起床時間を記録（JST）
-        now = jst_now()
-        ts_str = now.strftime("%H:%M:%S")
-        day_str = now.strftime("%Y-%m-%d")
+        # 正解 → 起床時間を記録し、同じ接続・同じトランザクションで称号も判定する
+        with db_cursor() as cur:
+            # 起床ログはクラッシュ時に直近数件が失われても困らないので、WALのfsyncを待たずにコミットする
+            cur.execute("SET LOCAL synchronous_commit = OFF")
+            ts, day = insert_wakeup(cur, name)
+            award = evaluate_all_titles(cur, name, day)
+
+        # 起床ログのコミット後に、称号の付与はバックグラウンドに任せる
+        enqueue_grants(award["grants"])
 
-        conn = get_db_conn()
-        cur = conn.cursor()
-        cur.execute(
-            "INSERT INTO wakeups (name, ts, day) VALUES (%s, %s, %s)",
-            (name, ts_str, day_str),
-        )
-        conn.commit()
-        cur.close()
-        conn.close()
-        
-        award = evaluate_and_grant_all_titles(name, day_str)
         streak = award["streak"]
 
         new_msgs = []
@@ -811,95 +1169,112 @@ def index():
         extra = ("<br>" + "<br>".join(new_msgs)) if new_msgs else ""
 
 
-        return render_template_string(
-            RESULT_HTML,
+        return _RESULT_TPL.render(
             ok=True,
             title="✅ ログイン成功！",
-            message=f"{name} さんの起床時間（{ts_str}）を記録しました。連続ログイン：{streak}日{extra}",
+            message=f"{name} さんの起床時間（{ts}）を記録しました。連続ログイン：{streak}日{extra}",
             explanation=quiz.get("explanation") or None,
             )
 
 
-    # GET
-    return render_template_string(
-        INDEX_HTML,
-        error=None,
-        quiz_question=quiz["question"],
-        quiz_choices=quiz["choices"],
-        quiz_category=quiz.get("category", ""),
-        quiz_count=len(QUIZ_BANK),
-    )
+    # GET（描画済みのページをそのまま返す）
+    return Response(get_today_index_page(), mimetype="text/html")
 
 
 @app.route("/today")
 def today():
-    today_str = jst_today().strftime("%Y-%m-%d")
-
-    conn = get_db_conn()
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT name, ts FROM wakeups WHERE day = %s ORDER BY ts ASC",
-        (today_str,),
+    PAGE_SIZE = 500  # 1ページに出す最大件数
+    offset = max(0, request.args.get("offset", default=0, type=int))
+
+    today_date = jst_today()
+    today_str = today_date.isoformat()
+
+    with db_cursor() as cur:
+        # 今日の行の最大id・件数が変わっていなければページも同じ
+        execute_prepared(cur, "stat_today", (today_date,))
+        max_id, count = cur.fetchone()
+        etag = f"today-{today_str}-{offset}-{max_id}-{count}"
+        if request.if_none_match.contains(etag):
+            return not_modified_response(etag)
+
+        # 1件多めに取って「次のページがあるか」を判定する
+        execute_prepared(cur, "sel_today", (today_date, PAGE_SIZE + 1, offset))
+        rows = cur.fetchall()
+
+    next_offset = offset + PAGE_SIZE if len(rows) > PAGE_SIZE else None
+
+    body = _TODAY_TPL.render(
+        today_str=today_str,
+        rows=rows[:PAGE_SIZE],
+        next_offset=next_offset,
     )
-    rows = cur.fetchall()
-    cur.close()
-    conn.close()
-
-    return render_template_string(TODAY_HTML, today_str=today_str, rows=rows)
+    return cacheable_response(body, etag)
 
 
 @app.route("/history")
 def history():
     N_DAYS_HISTORY = 30  # 好きに変更OK（例：30日表示）
+    PAGE_SIZE = 5000  # 1ページに出す最大件数
+    offset = max(0, request.args.get("offset", default=0, type=int))
 
     end_date = jst_today()
     start_date = end_date - timedelta(days=N_DAYS_HISTORY - 1)
 
-    start_str = start_date.strftime("%Y-%m-%d")
-    end_str = end_date.strftime("%Y-%m-%d")
+    start_str = start_date.isoformat()
+    end_str = end_date.isoformat()
 
-    conn = get_db_conn()
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT day, name, ts
-        FROM wakeups
-        WHERE day BETWEEN %s AND %s
-        ORDER BY day DESC, ts ASC
-    """, (start_str, end_str))
-    rows = cur.fetchall()
-    cur.close()
-    conn.close()
+    with db_cursor() as cur:
+        # 期間内の行の最大id・件数が変わっていなければページも同じ
+        execute_prepared(cur, "stat_history", (start_date, end_date))
+        max_id, count = cur.fetchone()
+        etag = f"history-{start_str}-{end_str}-{offset}-{max_id}-{count}"
+        if request.if_none_match.contains(etag):
+            return not_modified_response(etag)
 
-    rows_by_day_dict = {}
-    for day_str, name, ts in rows:
-        rows_by_day_dict.setdefault(day_str, []).append((name, ts))
+        # 件数は上で数えてあるので、次のページの有無はそれで判定する
+        next_offset = offset + PAGE_SIZE if count > offset + PAGE_SIZE else None
 
-    rows_by_day = sorted(rows_by_day_dict.items(), key=lambda x: x[0], reverse=True)
+        # SQL 側で day ごとにまとめる（1日1行で返ってくる）
+        execute_prepared(cur, "sel_history", (start_date, end_date, PAGE_SIZE, offset))
+        rows_by_day = cur.fetchall()
 
-    return render_template_string(
-        HISTORY_HTML,
+    body = _HISTORY_TPL.render(
         rows_by_day=rows_by_day,
         start_str=start_str,
         end_str=end_str,
+        next_offset=next_offset,
     )
+    return cacheable_response(body, etag)
 
 
 # （確認用：必要なときだけ使って、動いたら消してOK）
 @app.route("/admin/dbinfo")
 def admin_dbinfo():
-    conn = get_db_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT COUNT(*), MIN(day), MAX(day) FROM wakeups")
-    count, minday, maxday = cur.fetchone()
-    cur.close()
-    conn.close()
-    return {"count": count, "min_day": minday, "max_day": maxday}
+    with db_cursor() as cur:
+        # 件数は全件を数えず、統計情報（ANALYZE / autovacuum で更新される推定値）を使う。
+        # MIN / MAX は idx_wakeups_day_ts の両端を見るだけで済む
+        cur.execute("""
+            SELECT
+                GREATEST(c.reltuples, 0)::bigint,
+                (SELECT MIN(day) FROM wakeups),
+                (SELECT MAX(day) FROM wakeups)
+            FROM pg_class c
+            WHERE c.oid = 'wakeups'::regclass
+        """)
+        count, minday, maxday = cur.fetchone()
+    return {
+        "count": count,
+        "min_day": minday.isoformat() if minday else None,
+        "max_day": maxday.isoformat() if maxday else None,
+    }
 
 
 if __name__ == "__main__":
     # ローカル起動用。Renderではgunicornが起動するのでここは使われません
     app.run(host="0.0.0.0", port=5000, debug=True)
 
+CSV_BATCH_SIZE = 1000  # CSV を何行ずつ DB から受け取って送るか
+
 @app.route("/download/wakeups.csv")
 def download_wakeups_csv():
     # クエリパラメータ（任意）
@@ -913,81 +1288,79 @@ def download_wakeups_csv():
     end_date = jst_today()
     if days:
         start_date = end_date - timedelta(days=max(1, days) - 1)
-        start_str = start_date.strftime("%Y-%m-%d")
-        end_str = end_date.strftime("%Y-%m-%d")
     elif start and end:
-        # 形式チェックは最低限（厳密にしたければ後で追加）
-        start_str, end_str = start.strip(), end.strip()
+        # day は DATE 型なので、日付として読めない値はここで弾く
+        try:
+            start_date = date.fromisoformat(start.strip())
+            end_date = date.fromisoformat(end.strip())
+        except ValueError:
+            return Response("start / end は YYYY-MM-DD 形式で指定してください。", status=400)
     else:
         # デフォルト：直近30日
         start_date = end_date - timedelta(days=29)
-        start_str = start_date.strftime("%Y-%m-%d")
-        end_str = end_date.strftime("%Y-%m-%d")
-
-    # DBから取得
-    conn = get_db_conn()
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT day, ts, name
-        FROM wakeups
-        WHERE day BETWEEN %s AND %s
-        ORDER BY day ASC, ts ASC
-    """, (start_str, end_str))
-    rows = cur.fetchall()
-    cur.close()
-    conn.close()
-
-    # CSV生成（メモリ上）
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(["day", "ts", "name"])
-    writer.writerows(rows)
-
-    csv_text = output.getvalue()
-    output.close()
-
-    # ★ここがポイント：Excel向けにUTF-8 BOM付きで返す
-    csv_bytes = csv_text.encode("utf-8-sig")  # BOM付きUTF-8
+    start_str = start_date.isoformat()
+    end_str = end_date.isoformat()
+
+    # DBからサーバーサイドカーソルで少しずつ読み、CSV にしたそばから送る（全件をメモリに載せない）
+    def generate():
+        with db_cursor(name="csv_cur") as cur:
+            cur.execute("""
+                SELECT day, ts, name
+                FROM wakeups
+                WHERE day BETWEEN %s AND %s
+                ORDER BY day ASC, ts ASC
+            """, (start_date, end_date))
+
+            output = io.StringIO()
+            writer = csv.writer(output)
+            writer.writerow(["day", "ts", "name"])
+
+            # ★ここがポイント：Excel向けにUTF-8 BOM付きで返す（BOM は先頭の1回だけ）
+            prefix = "\ufeff"
+            for rows in iter(lambda: cur.fetchmany(CSV_BATCH_SIZE), []):
+                writer.writerows(rows)
+                yield (prefix + output.getvalue()).encode("utf-8")
+                prefix = ""
+                output.seek(0)
+                output.truncate()
+
+            # 1行も無い場合もヘッダーだけは返す
+            if prefix:
+                yield (prefix + output.getvalue()).encode("utf-8")
 
     filename = f"wakeups_{start_str}_to_{end_str}.csv"
     return Response(
-        csv_bytes,
+        generate(),
         mimetype="text/csv; charset=utf-8",
         headers={"Content-Disposition": f'attachment; filename="{filename}"'}
     )
 
 @app.route("/admin/titles")
 def admin_titles():
-    conn = get_db_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT code, name, is_hidden FROM titles ORDER BY id;")
-    rows = cur.fetchall()
-    cur.close()
-    conn.close()
+    with db_cursor() as cur:
+        cur.execute("SELECT code, name, is_hidden FROM titles ORDER BY id;")
+        rows = cur.fetchall()
     return {"titles": rows}
 
 @app.route("/admin/user_titles")
 def admin_user_titles():
     user = request.args.get("user")
-    conn = get_db_conn()
-    cur = conn.cursor()
-    if user:
-        cur.execute("""
-            SELECT user_name, title_code, acquired_day
-            FROM user_titles
-            WHERE user_name = %s
-            ORDER BY acquired_day DESC
-        """, (user,))
-    else:
-        cur.execute("""
-            SELECT user_name, title_code, acquired_day
-            FROM user_titles
-            ORDER BY acquired_day DESC
-            LIMIT 200
-        """)
-    rows = cur.fetchall()
-    cur.close()
-    conn.close()
+    with db_cursor() as cur:
+        if user:
+            cur.execute("""
+                SELECT user_name, title_code, acquired_day
+                FROM user_titles
+                WHERE user_name = %s
+                ORDER BY acquired_day DESC
+            """, (user,))
+        else:
+            cur.execute("""
+                SELECT user_name, title_code, acquired_day
+                FROM user_titles
+                ORDER BY acquired_day DESC
+                LIMIT 200
+            """)
+        rows = cur.fetchall()
     return {"user_titles": rows}
 
 @app.route("/titles")
@@ -1001,8 +1374,7 @@ def titles_page():
     if user_query:
         user_titles = fetch_user_titles(user_query)
 
-    return render_template_string(
-        TITLES_HTML,
+    return _TITLES_TPL.render(
         titles=titles,
         user_query=user_query,
         user_titles=user_titles,
@@ -0,0 +1,19 @@
+# gunicorn 設定（Procfile: gunicorn -c gunicorn.conf.py app:app）
+import os
+
+# ルートはほぼDB待ちなので、スレッド型ワーカーで同時リクエストをさばく。
+# ワーカーごとに DB 接続を最大 threads + 1 本持つので、Postgres への接続は最大 workers × (threads + 1) 本になる。
+# cpu_count() はコンテナの CPU 割り当てではなくホストのコア数を返し、max_connections を超えかねないので、
+# ワーカー数は小さい固定値を既定にして、必要なら WEB_CONCURRENCY で増やす
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 8))  # app.DB_POOL_MAXCONN もこの値から決まる（スレッド数 + 1）
+
+# マスターで一度だけ app を読み込み（クイズExcel・テンプレート）、ワーカーは fork で共有する
+preload_app = True
+
+
+def when_ready(server):
+    # preload 時の init_db / seed_titles で作った接続をワーカーに引き継がないよう、fork 前に閉じる
+    import app
+    app.close_db_pool()